@@ -1,43 +1,106 @@
 import asyncio
-import contextlib
+import dis
 import functools
 import sys
 import traceback
 
 from codeop import CommandCompiler
-from io import BytesIO, StringIO
+from io import StringIO
 
 
 __all__ = ['start_manhole']
 
 
+if not hasattr(sys, 'ps1'):
+    sys.ps1 = ">>> "
+if not hasattr(sys, 'ps2'):
+    sys.ps2 = "... "
+
+
 class StatefulCommandCompiler(CommandCompiler):
     """A command compiler that buffers input until a full command is available."""
 
     def __init__(self):
         super().__init__()
-        self.buf = BytesIO()
+        self.buf = bytearray()
+        # Code objects are immutable, so repeated one-liners (``ps()`` and
+        # friends) can reuse a previous compilation. This survives reset().
+        self._compile_cached = functools.lru_cache(maxsize=256)(self._compile)
 
     def is_partial_command(self):
-        return bool(self.buf.getvalue())
+        return bool(self.buf)
 
     def __call__(self, source, **kwargs):
         buf = self.buf
-        if self.is_partial_command():
-            buf.write(b'\n')
-        buf.write(source)
+        partial = bool(buf)
+        if partial:
+            buf.append(0x0A)
+        buf.extend(source)
 
-        code = self.buf.getvalue().decode('utf8')
+        code = buf.decode('utf8')
 
-        codeobj = super().__call__(code, **kwargs)
+        if partial or '\n' in code:
+            codeobj = super().__call__(code, **kwargs)
+        else:
+            codeobj = self._compile_cached(code, self.compiler.flags, **kwargs)
 
         if codeobj:
             self.reset()
         return codeobj
 
+    def _compile(self, code, flags, **kwargs):
+        # flags is only here to be part of the cache key, as __future__
+        # imports change how the same source compiles.
+        return super().__call__(code, **kwargs)
+
+    def reset(self):
+        del self.buf[:]
+
+
+class _LazyStringIO:
+    """A stand-in for sys.stdout that only allocates a StringIO on first use.
+
+    Most commands (``>>> 5``) never print anything, so there's no point paying
+    for a buffer. Once allocated, the buffer is reused across commands.
+    """
+
+    def __init__(self):
+        self._buf = None
+
+    def _get_buf(self):
+        if self._buf is None:
+            self._buf = StringIO()
+        return self._buf
+
     def reset(self):
-        self.buf.seek(0)
-        self.buf.truncate(0)
+        if self._buf is not None:
+            self._buf.seek(0)
+            self._buf.truncate(0)
+
+    def write(self, s):
+        return self._get_buf().write(s)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        if self._buf is None:
+            return ''
+        return self._buf.getvalue()
+
+    def __getattr__(self, name):
+        return getattr(self._get_buf(), name)
+
+
+def _encode_banner(banner):
+    if isinstance(banner, bytes):
+        return banner
+    elif isinstance(banner, str):
+        return banner.encode('utf8')
+    elif banner is None:
+        return b''
+    else:
+        raise ValueError("Cannot handle unknown banner type {}, expected str or bytes".format(banner.__class__.__name__))
 
 
 class InteractiveInterpreter:
@@ -48,34 +111,36 @@ class InteractiveInterpreter:
         self.banner = self.get_banner(banner)
         self.compiler = StatefulCommandCompiler()
         self.loop = loop
+        self._stdout_buf = _LazyStringIO()
+        self._ps1_bytes = sys.ps1.encode('utf8')
+        self._ps2_bytes = sys.ps2.encode('utf8')
 
     def get_banner(self, banner):
-        if isinstance(banner, bytes):
-            return banner
-        elif isinstance(banner, str):
-            return banner.encode('utf8')
-        elif banner is None:
-            return b''
-        else:
-            raise ValueError("Cannot handle unknown banner type {!}, expected str or bytes".format(banner.__class__.__name__))
-
-    def attempt_compile(self, line):
-        return self.compiler(line)
+        return _encode_banner(banner)
 
     @asyncio.coroutine
     def send_exception(self):
         """When an exception has occurred, write the traceback to the user."""
+        writer = self.writer
         self.compiler.reset()
 
-        exc = traceback.format_exc()
-        self.writer.write(exc.encode('utf8'))
+        exc_type, exc_value, tb = sys.exc_info()
+        writer.writelines(
+            line.encode('utf8')
+            for line in traceback.TracebackException(exc_type, exc_value, tb).format())
 
-        yield from self.writer.drain()
+        yield from writer.drain()
 
     @asyncio.coroutine
     def attempt_exec(self, codeobj, namespace):
-        with contextlib.redirect_stdout(StringIO()) as buf:
+        buf = self._stdout_buf
+        buf.reset()
+        old_stdout = sys.stdout
+        sys.stdout = buf
+        try:
             value = yield from self._real_exec(codeobj, namespace)
+        finally:
+            sys.stdout = old_stdout
 
         return value, buf.getvalue()
 
@@ -88,32 +153,41 @@ class InteractiveInterpreter:
     def handle_one_command(self):
         """Process a single command. May have many lines."""
 
+        yield from self.write_prompt()
+
         while True:
-            yield from self.write_prompt()
             codeobj = yield from self.read_command()
 
-            if codeobj is not None:
+            if codeobj is None:
+                yield from self.write_prompt()
+            else:
+                # the next prompt goes out in the same batch as the output
                 yield from self.run_command(codeobj)
 
     @asyncio.coroutine
     def run_command(self, codeobj):
-        """Execute a compiled code object, and write the output back to the client."""
+        """Execute a compiled code object, and write the output back to the
+        client, followed by the next prompt."""
         try:
             value, stdout = yield from self.attempt_exec(codeobj, self.namespace)
         except Exception:
             yield from self.send_exception()
+            yield from self.write_prompt()
             return
         else:
-            yield from self.send_output(value, stdout)
+            yield from self.send_output(value, stdout, prompt=self.get_prompt())
+
+    def get_prompt(self):
+        if self.compiler.is_partial_command():
+            return self._ps2_bytes
+        else:
+            return self._ps1_bytes
 
     @asyncio.coroutine
     def write_prompt(self):
         writer = self.writer
 
-        if self.compiler.is_partial_command():
-            writer.write(sys.ps2.encode('utf8'))
-        else:
-            writer.write(sys.ps1.encode('utf8'))
+        writer.write(self.get_prompt())
 
         yield from writer.drain()
 
@@ -125,23 +199,44 @@ class InteractiveInterpreter:
         """
 
         reader = self.reader
+        writer = self.writer
+        compiler = self.compiler
 
-        line = yield from reader.readline()
-        if line == b'':  # lost connection
-            raise ConnectionResetError()
-
-        try:
-            # skip the newline to make CommandCompiler work as advertised
-            codeobj = self.attempt_compile(line.rstrip(b'\n'))
-        except SyntaxError:
-            yield from self.send_exception()
-            return
+        while True:
+            line = yield from reader.readline()
+            if line == b'':  # lost connection
+                raise ConnectionResetError()
 
-        return codeobj
+            try:
+                # skip the newline to make CommandCompiler work as advertised.
+                # readline() only omits it when EOF cuts the line short.
+                if line.endswith(b'\n'):
+                    line = line[:-1]
+                codeobj = compiler(line)
+            except SyntaxError:
+                yield from self.send_exception()
+                return
+
+            # Pasted blocks arrive all at once, so keep feeding the compiler
+            # from what's already buffered instead of draining a continuation
+            # prompt for every line.
+            if codeobj is not None or not compiler.is_partial_command():
+                return codeobj
+
+            if not self._has_buffered_line(reader):
+                return
+
+            writer.write(self.get_prompt())
+
+    @staticmethod
+    def _has_buffered_line(reader):
+        # StreamReader has no public way to peek at its buffer (bpo-32052).
+        return b'\n' in getattr(reader, '_buffer', b'')
 
     @asyncio.coroutine
-    def send_output(self, value, stdout):
-        """Write the output or value of the expression back to user.
+    def send_output(self, value, stdout, prompt=b''):
+        """Write the output or value of the expression back to user, along
+        with the prompt for the next command if given.
 
         >>> 5
         5
@@ -150,24 +245,21 @@ class InteractiveInterpreter:
         """
 
         writer = self.writer
+        parts = []
 
         if value is not None:
-            writer.write('{!r}\n'.format(value).encode('utf8'))
+            parts.append((repr(value) + '\n').encode('utf8'))
 
         if stdout:
-            writer.write(stdout.encode('utf8'))
+            parts.append(stdout.encode('utf8'))
 
-        yield from writer.drain()
+        if prompt:
+            parts.append(prompt)
 
-    def _setup_prompts(self):
-        try:
-            sys.ps1
-        except AttributeError:
-            sys.ps1 = ">>> "
-        try:
-            sys.ps2
-        except AttributeError:
-            sys.ps2 = "... "
+        if parts:
+            writer.write(b''.join(parts))
+
+        yield from writer.drain()
 
     @asyncio.coroutine
     def __call__(self, reader, writer):
@@ -176,8 +268,6 @@ class InteractiveInterpreter:
         self.reader = reader
         self.writer = writer
 
-        self._setup_prompts()
-
         if self.banner:
             writer.write(self.banner)
             yield from writer.drain()
@@ -192,6 +282,28 @@ class InteractiveInterpreter:
                 traceback.print_exc()
 
 
+# Opcodes that only move names and constants around. Anything else
+# (displaying a value, operators, subscripts, attribute access, calls, loops)
+# may do real work or end up in user-defined methods, so it goes to the
+# executor where command_timeout applies. STORE_NAME can still drop the last
+# reference to an object with a __del__, which is accepted here.
+_TRIVIAL_OPCODES = {'LOAD_NAME', 'LOAD_CONST', 'STORE_NAME', 'RETURN_VALUE', 'NOP', 'POP_TOP'}
+if sys.version_info >= (3, 11):
+    _TRIVIAL_OPCODES.add('RESUME')
+if sys.version_info >= (3, 12):
+    # fused LOAD_CONST + RETURN_VALUE
+    _TRIVIAL_OPCODES.add('RETURN_CONST')
+_TRIVIAL_OPCODES = frozenset(_TRIVIAL_OPCODES)
+
+
+@functools.lru_cache(maxsize=256)
+def _is_trivial(codeobj):
+    """Return True if codeobj only shuffles names and constants around, so it's
+    safe and cheaper to run it directly in the event loop."""
+    return all(instruction.opname in _TRIVIAL_OPCODES
+               for instruction in dis.get_instructions(codeobj))
+
+
 class ThreadedInteractiveInterpreter(InteractiveInterpreter):
     """An interactive asynchronous interpreter that executes
     statements/expressions in a thread.
@@ -202,17 +314,39 @@ class ThreadedInteractiveInterpreter(InteractiveInterpreter):
     Also accepts a timeout, which defaults to five seconds. This won't kill
     the running statement (good luck killing a thread) but it will at least
     yield control back to the manhole.
+
+    Trivial statements that only load and store names and constants (e.g.
+    ``x = 5``) skip the thread pool and are executed in the loop directly.
+
+    _run_in_executor is bound on the instance in __init__, depending on
+    command_timeout, so subclasses should override the _with_timeout and
+    _no_timeout variants (or _real_exec) rather than _run_in_executor.
     """
     def __init__(self, *args, command_timeout=5, **kwargs):
         super().__init__(*args, **kwargs)
         self.command_timeout = command_timeout
+        if command_timeout:
+            self._run_in_executor = self._run_in_executor_with_timeout
+        else:
+            self._run_in_executor = self._run_in_executor_no_timeout
 
     @asyncio.coroutine
     def _real_exec(self, codeobj, namespace):
+        if _is_trivial(codeobj):
+            return eval(codeobj, namespace)
+
+        value = yield from self._run_in_executor(codeobj, namespace)
+        return value
+
+    @asyncio.coroutine
+    def _run_in_executor_no_timeout(self, codeobj, namespace):
+        value = yield from self.loop.run_in_executor(None, eval, codeobj, namespace)
+        return value
+
+    @asyncio.coroutine
+    def _run_in_executor_with_timeout(self, codeobj, namespace):
         task = self.loop.run_in_executor(None, eval, codeobj, namespace)
-        if self.command_timeout:
-            task = asyncio.wait_for(task, self.command_timeout, loop=self.loop)
-        value = yield from task
+        value = yield from asyncio.wait_for(task, self.command_timeout)
         return value
 
 
@@ -224,6 +358,9 @@ class InterpreterFactory:
         self.namespace = namespace or {}
         self.shared = shared
         self.args = args
+        if 'banner' in kwargs:
+            # encode once, so every client shares the same bytes
+            kwargs['banner'] = _encode_banner(kwargs['banner'])
         self.kwargs = kwargs
         self.loop = loop or asyncio.get_event_loop()
 
@@ -234,7 +371,7 @@ class InterpreterFactory:
             namespace=self.namespace if self.shared else dict(self.namespace),
             **self.kwargs
         )
-        return asyncio.ensure_future(interpreter(reader, writer), loop=self.loop)
+        return self.loop.create_task(interpreter(reader, writer))
 
 
 def start_manhole(banner=None, host='127.0.0.1', port=None, path=None,
@@ -265,28 +402,27 @@ def start_manhole(banner=None, host='127.0.0.1', port=None, path=None,
         raise ValueError('At least one of port or path must be given')
 
     if threaded:
-        interpreter_class = functools.partial(
-            ThreadedInteractiveInterpreter, command_timeout=command_timeout)
+        interpreter_class = ThreadedInteractiveInterpreter
+        interpreter_kwargs = {'command_timeout': command_timeout}
     else:
         interpreter_class = InteractiveInterpreter
+        interpreter_kwargs = {}
 
     client_cb = InterpreterFactory(
         interpreter_class, shared=shared, namespace=namespace, banner=banner,
-        loop=loop)
+        loop=loop, **interpreter_kwargs)
 
     coros = []
 
     if path:
-        f = asyncio.ensure_future(
-            asyncio.start_unix_server(client_cb, path=path, loop=loop), loop=loop)
+        f = loop.create_task(asyncio.start_unix_server(client_cb, path=path))
         coros.append(f)
 
     if port is not None:
-        f = asyncio.ensure_future(asyncio.start_server(
-            client_cb, host=host, port=port, loop=loop), loop=loop)
+        f = loop.create_task(asyncio.start_server(client_cb, host=host, port=port))
         coros.append(f)
 
-    return asyncio.gather(*coros, loop=loop)
+    return asyncio.gather(*coros)
 
 
 if __name__ == '__main__':
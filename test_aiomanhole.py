@@ -3,13 +3,17 @@ from contextlib import contextmanager
 import os
 import shutil
 import tempfile
+import time
 
 from io import BytesIO
 from unittest import mock
 
 import pytest
 
-from aiomanhole import StatefulCommandCompiler, InteractiveInterpreter, start_manhole
+import aiomanhole
+from aiomanhole import (
+    StatefulCommandCompiler, InteractiveInterpreter, InterpreterFactory,
+    ThreadedInteractiveInterpreter, start_manhole, _is_trivial)
 
 
 @pytest.fixture(scope='function')
@@ -33,12 +37,12 @@ def loop():
     return loop
 
 @contextmanager
-def tcp_server(loop):
-    (server,) = loop.run_until_complete(start_manhole(port=0, loop=loop))
+def tcp_server(loop, **kwargs):
+    (server,) = loop.run_until_complete(start_manhole(port=0, loop=loop, **kwargs))
     (socket,) = server.sockets
     (ip, port) = socket.getsockname()
 
-    yield loop.run_until_complete(asyncio.open_connection('127.0.0.1', port, loop=loop))
+    yield loop.run_until_complete(asyncio.open_connection('127.0.0.1', port))
 
     server.close()
     loop.run_until_complete(server.wait_closed())
@@ -51,7 +55,7 @@ def unix_server(loop):
         domain_socket = os.path.join(directory, 'aiomanhole')
         (server,) = loop.run_until_complete(start_manhole(path=domain_socket, loop=loop))
 
-        yield loop.run_until_complete(asyncio.open_unix_connection(path=domain_socket, loop=loop))
+        yield loop.run_until_complete(asyncio.open_unix_connection(path=domain_socket))
 
         server.close()
         loop.run_until_complete(server.wait_closed())
@@ -60,7 +64,7 @@ def unix_server(loop):
         shutil.rmtree(directory)
 
 
-async def send_command(message, reader, writer, loop):
+async def send_command(message, reader, writer, loop, separator=b'\n>>>'):
     # Prompt on connect
     assert await reader.read(4) == b'>>> '
 
@@ -68,10 +72,9 @@ async def send_command(message, reader, writer, loop):
     writer.write(message)
 
     # Read until we see the next prompt, then strip off the prompt
-    prompt = b'\n>>>'
-    response = await reader.readuntil(separator=prompt)
+    response = await reader.readuntil(separator=separator)
     writer.close()
-    return response[:-len(prompt)]
+    return response[:-len(separator)]
 
 
 class MockStream:
@@ -81,6 +84,10 @@ class MockStream:
     def write(self, data):
         self.buf.write(data)
 
+    def writelines(self, data):
+        for line in data:
+            self.write(line)
+
     @asyncio.coroutine
     def drain(self):
         yield
@@ -109,6 +116,17 @@ class TestStatefulCommandCompiler:
 
         assert compiler(b'import asyncio') is not None
 
+    def test_one_line__reuses_code_object(self, compiler):
+        f = compiler(b'f = 5')
+        assert compiler(b'f = 5') is f
+
+    def test_one_line__cache_respects_future_imports(self, compiler):
+        pytest.raises(NameError, eval, compiler(b'y: Undefined = 1'), {})
+
+        eval(compiler(b'from __future__ import annotations'), {})
+
+        eval(compiler(b'y: Undefined = 1'), {})
+
     MULTI_LINE_1 = [
         b'try:',
         b'    raise Exception',
@@ -201,8 +219,7 @@ class TestInteractiveInterpreter:
     @pytest.mark.parametrize('partial', [True, False])
     def test_write_prompt(self, interpreter, loop, partial):
         with mock.patch.object(interpreter.compiler, 'is_partial_command', return_value=partial):
-            with mock.patch('sys.ps1', '>>> ', create=True), mock.patch('sys.ps2', '... ', create=True):
-                loop.run_until_complete(interpreter.write_prompt())
+            loop.run_until_complete(interpreter.write_prompt())
 
         expected_value = b'... ' if partial else b'>>> '
         assert interpreter.writer.buf.getvalue() == expected_value
@@ -234,6 +251,46 @@ class TestInteractiveInterpreter:
         output = interpreter.writer.buf.getvalue()
         assert output == expected_output
 
+    def test_run_command__output_does_not_leak_between_commands(self, interpreter, loop):
+        loop.run_until_complete(interpreter.run_command(interpreter.compiler(b'print("a")')))
+        assert interpreter.writer.buf.getvalue() == b'a\n>>> '
+
+        interpreter.writer = MockStream()
+        loop.run_until_complete(interpreter.run_command(interpreter.compiler(b'5')))
+        assert interpreter.writer.buf.getvalue() == b'5\n>>> '
+
+    def test_run_command__slow_repr_hits_command_timeout(self, loop):
+        class SlowRepr:
+            def __repr__(self):
+                time.sleep(0.3)
+                return 'slow'
+
+        interpreter = ThreadedInteractiveInterpreter(
+            {'obj': SlowRepr()}, '', loop, command_timeout=0.1)
+        interpreter.writer = MockStream()
+
+        loop.run_until_complete(interpreter.run_command(interpreter.compiler(b'obj')))
+
+        output = interpreter.writer.buf.getvalue()
+        assert b'TimeoutError' in output
+        assert output.endswith(b'>>> ')
+
+    def test_send_exception(self, interpreter, loop):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            loop.run_until_complete(interpreter.send_exception())
+
+        output = interpreter.writer.buf.getvalue()
+        assert output.startswith(b'Traceback (most recent call last):\n')
+        assert output.endswith(b'ZeroDivisionError: division by zero\n')
+
+    def test_send_output__with_prompt(self, interpreter, loop):
+        loop.run_until_complete(interpreter.send_output(5, 'hello', prompt=b'>>> '))
+
+        output = interpreter.writer.buf.getvalue()
+        assert output == b'5\nhello>>> '
+
     @pytest.mark.parametrize('stdin,expected_output', [
         (b'print("hello")', b'hello'),
         (b'101', b'101'),
@@ -243,3 +300,87 @@ class TestInteractiveInterpreter:
         with server_factory(loop=loop) as (reader, writer):
             output = loop.run_until_complete(send_command(stdin + b'\n', reader, writer, loop))
             assert output == expected_output
+
+    @pytest.mark.parametrize('server_factory', [tcp_server, unix_server])
+    def test_pasted_block_over_localhost_network(self, loop, server_factory):
+        stdin = b'def f():\n    print("hello")\n\nf()\n'
+        with server_factory(loop=loop) as (reader, writer):
+            output = loop.run_until_complete(send_command(stdin, reader, writer, loop))
+            assert output == b'... ... >>> hello'
+
+    @pytest.mark.parametrize('server_factory', [tcp_server, unix_server])
+    def test_pasted_block_with_syntax_error_over_localhost_network(self, loop, server_factory):
+        stdin = b'def f():\n    return )\n5\n'
+        with server_factory(loop=loop) as (reader, writer):
+            # the rest of the paste still runs after the error
+            output = loop.run_until_complete(send_command(
+                stdin, reader, writer, loop, separator=b'\n>>> 5\n>>>'))
+            assert output.startswith(b'... Traceback (most recent call last):\n')
+            assert output.count(b'Traceback') == 1
+            assert output.splitlines()[-1].startswith(b'SyntaxError: ')
+
+
+# Checked against the bytecode of CPython 3.6 to 3.13; the opcode table in
+# aiomanhole is gated on version to cover 3.11's RESUME and 3.12's
+# RETURN_CONST.
+@pytest.mark.parametrize('source,expected', [
+    ('x', False),
+    ('x = 5', True),
+    ('x = y', True),
+    ('x.y', False),
+    ('x + 1', False),
+    ('10 ** 10 ** 8', False),
+    ("'a' * 10 ** 10", False),
+    ('x[0]', False),
+    ('a in b', False),
+    ('f()', False),
+    ('import os', False),
+    ('for i in x:\n    pass\n', False),
+    ('while x:\n    pass\n', False),
+])
+def test_is_trivial(source, expected):
+    assert _is_trivial(compile(source, '<input>', 'single')) is expected
+
+
+class TestInterpreterFactory:
+    def test_banner_is_encoded_once(self, loop):
+        with mock.patch('aiomanhole._encode_banner', wraps=aiomanhole._encode_banner) as encode:
+            factory = InterpreterFactory(InteractiveInterpreter, banner='hello', loop=loop)
+            tasks = [factory(MockStream(), MockStream()) for _ in range(2)]
+
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+        # once for the factory, then once per connection with the encoded bytes
+        assert encode.call_count == 3
+        str_calls = [c for c in encode.call_args_list if isinstance(c[0][0], str)]
+        assert str_calls == [mock.call('hello')]
+
+    def test_banner_with_custom_get_banner(self, loop):
+        class CustomInterpreter(InteractiveInterpreter):
+            def get_banner(self, banner):
+                return b'custom ' + super().get_banner(banner)
+
+        factory = InterpreterFactory(CustomInterpreter, banner='hello', loop=loop)
+        assert factory.kwargs['banner'] == b'hello'
+
+        interpreter = factory.interpreter_class(namespace={}, loop=loop, **factory.kwargs)
+        assert interpreter.banner == b'custom hello'
+
+    @pytest.mark.parametrize('stdin,expected_output', [
+        (b'dir()', b"['__builtins__', 'x']"),
+        (b'globals().get("x")', b'1'),
+    ])
+    def test_unshared_namespace_is_visible(self, loop, stdin, expected_output):
+        with tcp_server(loop, namespace={'x': 1}) as (reader, writer):
+            output = loop.run_until_complete(send_command(stdin + b'\n', reader, writer, loop))
+            assert output == expected_output
+
+    def test_unshared_namespace_del(self, loop):
+        namespace = {'x': 1}
+        with tcp_server(loop, namespace=namespace) as (reader, writer):
+            output = loop.run_until_complete(send_command(b'del x\nx\n', reader, writer, loop))
+            assert output.endswith(b"NameError: name 'x' is not defined")
+
+        assert namespace == {'x': 1}